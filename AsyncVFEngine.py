@@ -1,100 +1,303 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import json
+import tempfile
 import netdev
 import asyncio
 import getpass
-from yaml import safe_load
+from collections import namedtuple
+from yaml import load
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import re2 as regex_engine
+except ImportError:
+    import re as regex_engine
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+SHOW_MAC_TABLE_COMMAND = 'show mac address-table'
+SHOW_SWITCHPORTS_COMMAND = 'show interfaces switchport'
+
+MAC_TABLE_REGEX = regex_engine.compile(r'(?m)^[ \t]*(?P<vlan>\d{1,4})\s+(?P<mac>[0-9a-f]{4}\.[0-9a-f]{4}\.[0-9a-f]{4})'
+                                       r'\s+(?P<type>\w+)\s+(?P<port>\S+)')
+
+SWITCHPORT_REGEX = regex_engine.compile(r'(?m)^(?P<field>Name|Operational Mode):(?P<value>[^\n]*)')
+
+PortInfo = namedtuple('PortInfo', 'vlan type port')
+
+MAC_SEPARATORS = str.maketrans('', '', ':-.')
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+MAX_CONCURRENCY = 8
+
+HIT_COUNTS_FILE = 'switch_hits.json'
+
+
+'''
+   Name - load_yaml
+
+   Description - This function parses the YAML file at 'path', using libyaml's C loader when PyYAML was built with
+   it and the pure-Python SafeLoader otherwise.
+
+   Parameters
+       - path - Path to the YAML file to load
+
+   Return - The parsed contents of the YAML file
+'''
+
+def load_yaml(path: str):
+    with open(path, "r") as handle:
+        return load(handle, Loader=SafeLoader)
+
+
+'''
+   Name - load_hit_counts
+
+   Description - This function reads how many end devices have previously been located on each switch from the JSON
+   file at 'path'.
+
+   Parameters
+       - path - Path to the JSON file holding the hit counts
+
+   Return - Dictionary with the switch address as the key and its hit count as the value.  Empty if the file does not
+            exist, can't be parsed, or does not hold an object of whole-number counts.
+'''
+
+def load_hit_counts(path: str):
+    try:
+        with open(path, "r") as handle:
+            hit_counts = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(hit_counts, dict):
+        return {}
+
+    if not all(isinstance(count, int) and not isinstance(count, bool) for count in hit_counts.values()):
+        return {}
+
+    return hit_counts
+
+
+'''
+   Name - save_hit_counts
+
+   Description - This function writes the per-switch hit counts to the JSON file at 'path'.  The counts are written to
+   a temporary file in the same directory, which then replaces 'path', so an interrupted write never leaves a
+   truncated file behind.
+
+   Parameters
+       - path - Path to the JSON file holding the hit counts
+       - hit_counts - Dictionary with the switch address as the key and its hit count as the value
+
+   Return - N/A
+'''
+
+def save_hit_counts(path: str, hit_counts):
+    directory = os.path.dirname(os.path.abspath(path))
+
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix='.tmp', delete=False) as handle:
+        try:
+            json.dump(hit_counts, handle, indent=2, sort_keys=True)
+        except BaseException:
+            handle.close()
+            os.remove(handle.name)
+            raise
+
+    os.replace(handle.name, path)
 
 
 '''
-   Name - create_mac_address_dictionary
+   Name - to_cisco_mac
 
-   Description - This function runs 'show mac address-table' on the ssh session represented by 'connection',
-   and creates a dictionary of that data with the mac address as the key of type string, and the remaining values
-   stored as a tuple
+   Description - This function normalizes a MAC address written with ':', '-' or '.' separators, in either case, to
+   the lowercase dotted 'xxxx.xxxx.xxxx' form that Cisco prints in 'show mac address-table'.
+
+   Parameters
+       - mac - MAC address to normalize
+
+   Return - String holding the MAC address in Cisco dotted form
+
+   Raises - ValueError if 'mac' is not a string, or does not hold exactly 12 hexadecimal digits once the separators are
+            removed.  YAML reads an unquoted colon-separated MAC such as 10:20:30:40:50:55 as a base-60 integer, so
+            such MACs must be quoted in end_devices.yml.
+'''
+
+def to_cisco_mac(mac):
+    if not isinstance(mac, str):
+        raise ValueError(f"{mac} was not read as a string; quote the MAC address in end_devices.yml")
+
+    digits = mac.lower().translate(MAC_SEPARATORS)
+
+    if len(digits) != 12 or not HEX_DIGITS.issuperset(digits):
+        raise ValueError(f'{mac} is not a valid MAC address')
+
+    return f'{digits[0:4]}.{digits[4:8]}.{digits[8:12]}'
+
+
+'''
+   Name - find_target_mac_entries
+
+   Description - This function runs 'show mac address-table' once on the ssh session represented by 'connection', and
+   parses the entries of the output whose mac address is in 'target_macs' into a dictionary with the mac address as
+   the key of type string, and a list of PortInfo named tuples as the value.  A mac address can appear on more than
+   one entry, for example on an access port and an uplink trunk, so every entry for it is kept.
 
    Parameters
        - connection - The active client session with the target switch
+       - target_macs - Collection of MAC addresses in Cisco dotted form
 
-   Return - Dictionary representing the output of 'show mac address-table | include <mac>' on the target switch, or 
-            None if MAC does  not appear in MAC address table
+   Return - Dictionary representing the entries of 'show mac address-table' on the target switch that belong to
+            'target_macs', in the order they appear in the output.  Empty if none were found.
 
 '''
 
-async def create_mac_address_dictionary(connection, mac):
-    result = await connection.send_command(f'show mac address-table | i {mac}')
-    
-    if result != '':
-        #result = result.split('\n')[0]
-        vlan, mac, porttype, port = result.split()
-        return {mac: {'vlan': vlan, 'type': porttype, 'port': port}}
-    
-    return None
+async def find_target_mac_entries(connection, target_macs):
+    result = await connection.send_command(SHOW_MAC_TABLE_COMMAND, strip_command=False, strip_prompt=False)
+
+    table = {}
+
+    for match in MAC_TABLE_REGEX.finditer(result):
+        mac = match.group('mac')
+
+        if mac in target_macs:
+            table.setdefault(mac, []).append(PortInfo(match.group('vlan'), match.group('type'), match.group('port')))
+
+    return table
 
 
 '''
-   Name - get_switchport_operational_mode
+   Name - fetch_switchport_modes
 
-   Description - This function runs 'show interface [interface] switchport' on the active ssh session represented by
-   'connection'.  The function then searches for the line that begins with 'Operational Mode.'  The value of that
-   field is returned as a string.
+   Description - This function runs 'show interfaces switchport' once on the active ssh session represented by
+   'connection'.  The output holds one section per interface, starting with a 'Name:' line.  The function pairs each
+   interface name with the value of the 'Operational Mode:' line that follows it in the same section.
 
    Parameters
        - connection - The active client session with the target switch
-       - portID - String representing the switchport interface ID e.g. Gi1/0
 
-   Return - String representing operational mode of the switchport, None if CLI command returns no output.
+   Return - Dictionary with the switchport interface ID (e.g. Gi1/0) as the key and its operational mode as the
+            value, both of type string.  Interfaces that are not switchports are left out.
+'''
+
+async def fetch_switchport_modes(connection):
+    result = await connection.send_command(SHOW_SWITCHPORTS_COMMAND, strip_command=False, strip_prompt=False)
+    modes = {}
+    port = None
+
+    for match in SWITCHPORT_REGEX.finditer(result):
+        if match.group('field') == 'Name':
+            port = match.group('value').strip()
+        elif port is not None:
+            modes[port] = match.group('value').strip()
+            port = None
+
+    return modes
+
 '''
+   Name - get_max_concurrency
 
-async def get_switchport_operational_mode(connection, portID: str):
-    result = await connection.send_command('show interface ' + portID + ' switchport | incl Operational Mode')
+   Description - This function reads the number of switches that may be searched at once from the VF_MAX_CONCURRENCY
+   environment variable.  If the variable is not set, MAX_CONCURRENCY is used.  If it is not a whole number of at
+   least 1, a message is printed and MAX_CONCURRENCY is used instead.
+
+   Parameters - None
+
+   Return - Integer holding the maximum number of switches to search concurrently
+'''
+
+def get_max_concurrency():
+    value = os.environ.get('VF_MAX_CONCURRENCY')
+
+    if value is None:
+        return MAX_CONCURRENCY
+
+    try:
+        max_concurrency = int(value)
+    except ValueError:
+        max_concurrency = 0
+
+    if max_concurrency < 1:
+        print(f"VF_MAX_CONCURRENCY must be a whole number of at least 1, not '{value}'.  Using {MAX_CONCURRENCY}...")
+        return MAX_CONCURRENCY
+
+    return max_concurrency
 
-    if result != '':
-        return result.split(":")[1]
-    
-    return None
 
 '''
    Name - find_mac_address_on_switch
 
-   Description - This function establishes an SSH connection with the switch running 'platform' at 'address' using  
-                 'username' and 'password' to authenticate.  The function then iterates over 'maclist', checking if
-                 an entry in 'maclist' shows in the switch's mac address table.  If so, check if it is a static 
-                 access port.  If so, we have found the port connected to the end device with the current mac address.  
+   Description - This function connects to the switch running 'platform' at 'switch_address' once a slot on
+                 'semaphore' is free.  It looks up every MAC address in 'target_macs' that is not yet in 'located' in
+                 the switch's mac address table, and records a MAC address in 'located' when one of its ports is a
+                 static access port.  The switch is skipped if every MAC address has already been located.
 
    Parameters
-       - address - Address of the switch to connect to
-       - username - username to use when authenticating with 'address'
+       - switch_address - Address of the switch to connect to
+       - username - username to use when authenticating with 'switch_address'
        - password - password to use with 'username'
        - platform - the platform/OS the target switch is running (e.g. cisco IOS, IOSXR, JunOS, etc.)
-       - maclist - list of MAC addresses of end devices that we are looking for
+       - target_macs - dictionary keyed by the MAC addresses of end devices that we are looking for
+       - located - dictionary mapping MAC addresses found on an access port to the address of that switch
+       - semaphore - asyncio.Semaphore limiting how many switches are searched concurrently
 
    Return - N/A
 '''
 
 
 
-async def find_mac_address_on_switch(switch_address: str, username: str, password: str, platform: str, maclist):
-    async with netdev.create(username=username, password=password, device_type=platform, host=switch_address) as connection:
-        print(f'Connected to {connection.base_prompt} successfully.')
+async def find_mac_address_on_switch(switch_address: str, username: str, password: str, platform: str, target_macs,
+                                     located, semaphore):
+    log = []
+
+    async with semaphore:
+        remaining = {mac: None for mac in target_macs if mac not in located}
 
-        for mac in maclist:
+        if not remaining:
+            sys.stdout.write(f"Every end device has already been located.  Skipping {switch_address}.\n")
+            return
 
-            mac_addr = mac['MAC']
-            mac_dict = await create_mac_address_dictionary(connection, mac_addr)
+        try:
+            async with netdev.create(username=username, password=password, device_type=platform,
+                                     host=switch_address) as connection:
+                log.append(f'Connected to {connection.base_prompt} successfully.')
 
-            if mac_dict is None:
-                print(f"{mac_addr} not found on {switch_address}.")
-                continue
+                target_entries = await find_target_mac_entries(connection, remaining)
+                port_modes = await fetch_switchport_modes(connection) if target_entries else {}
 
-            if mac_addr in mac_dict.keys():
-                print(f"{mac_addr} found on {mac_dict[mac_addr]['port']}.  Checking operational mode...")
-                result = await get_switchport_operational_mode(connection, mac_dict[mac_addr]['port'])
+                for mac_addr in remaining:
 
-                if 'access' in result.lower():
-                    print(f"MAC address {mac_addr} is located on {switch_address} on interface {mac_dict[mac_addr]['port']}")
-                else:
-                    print(f"{mac_dict[mac_addr]['port']} on {switch_address} is not operating as an access port.  Ignoring...")
+                    entries = target_entries.get(mac_addr)
+
+                    if entries is None:
+                        log.append(f"{mac_addr} not found on {switch_address}.")
+                        continue
+
+                    for entry in entries:
+                        log.append(f"{mac_addr} found on {entry.port}.  Checking operational mode...")
+
+                        if 'access' in port_modes.get(entry.port, '').lower():
+                            located[mac_addr] = switch_address
+                            log.append(f"MAC address {mac_addr} is located on {switch_address} on interface "
+                                       f"{entry.port}")
+                            break
+
+                        log.append(f"{entry.port} on {switch_address} is not operating as an access port.  "
+                                   f"Ignoring...")
+        finally:
+            if log:
+                sys.stdout.write('\n'.join(log) + '\n')
 
 
 '''
@@ -128,41 +331,71 @@ def get_credentials():
 
    Name - main
 
-   Description - Script's entry point.  First, it opens a YAML file that represents the switches that will be searched.
-   Next, it opens another YAML file that represents the end devices that we are looking for.  After, it creates a 
-   collection of asynchronous tasks for each switch.  The purpose is to be able to search multiple switches in parallel 
-   instead sequentially to boost speed.  One task is created and executed for each switch that needs to be searched.
+   Description - Script's entry point.  First, it opens a YAML file that represents the switches that will be
+   searched.  Next, it opens another YAML file that represents the end devices that we are looking for, and normalizes
+   their MAC addresses.  It then searches the switches concurrently, at most get_max_concurrency() at a time, starting
+   with the switches where the most end devices were located in previous runs, and reports any switch that failed.
 
    Parameters - None
       
    Return - N/A
 
-   Todo's - Tasks generate output, but nothing is done with it.  Can be used to return error messages, generate logs, 
-            etc.
-          - Right now, credentials to SSH into switches are stored in the YAML file.  First, this is insecure.  Second,
+   Todo's - Right now, credentials to SSH into switches are stored in the YAML file.  First, this is insecure.  Second,
             it is redundant since each entry in the YAML file has the creds repeated.  Prompt user to enter credentials
             securely, and use those for all switches.
 '''
 
                           
 async def main():
-    with open("switches.yml", "r") as switches_handle:
-        switches_root = safe_load(switches_handle)
-
-    with open("end_devices.yml", "r") as device_handle:
-        devices = safe_load(device_handle)
+    switches_root = load_yaml("switches.yml")
+    devices = load_yaml("end_devices.yml")
                           
+    target_macs = {}
+
+    for device in devices['end_devices']:
+        try:
+            target_macs[to_cisco_mac(device['MAC'])] = None
+        except ValueError as error:
+            print(f"{error}.  Ignoring...")
+
+    if not target_macs:
+        print("No valid end device MAC addresses to search for.")
+        return
+
+    hit_counts = load_hit_counts(HIT_COUNTS_FILE)
+    switch_list = sorted(switches_root['switch_list'], key=lambda switch: -hit_counts.get(switch['address'], 0))
+
     (username, password), = get_credentials().items()
+    located = {}
+    semaphore = asyncio.Semaphore(get_max_concurrency())
                           
-    connection_list = [asyncio.create_task(find_mac_address_on_switch(switch_address=switch['address'],
-                                                                      platform=switch['platform'],
-                                                                      username=username,
-                                                                      password=password,
-                                                                      maclist=devices['end_devices']))
-                       for switch in switches_root['switch_list']]
-
-    output = await asyncio.gather(*connection_list)
-    # print([line for line in (''.join([str(elem) for elem in output])).split('\\n')])
-    # print(output)
+    connection_list = [find_mac_address_on_switch(switch_address=switch['address'],
+                                                  platform=switch['platform'],
+                                                  username=username,
+                                                  password=password,
+                                                  target_macs=target_macs,
+                                                  located=located,
+                                                  semaphore=semaphore)
+                       for switch in switch_list]
+
+    output = await asyncio.gather(*connection_list, return_exceptions=True)
+
+    for switch, result in zip(switch_list, output):
+        if isinstance(result, BaseException):
+            print(f"Search of {switch['address']} failed: {result!r}")
+
+    for switch_address in located.values():
+        hit_counts[switch_address] = hit_counts.get(switch_address, 0) + 1
+
+    if located:
+        save_hit_counts(HIT_COUNTS_FILE, hit_counts)
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop is not None and hasattr(uvloop, 'run'):
+        uvloop.run(main())
+    else:
+        if uvloop is not None:
+            uvloop.install()
+
+        asyncio.run(main())